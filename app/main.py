@@ -2,11 +2,19 @@ import subprocess
 import os
 import sys
 import re
-import shutil
+import codecs
+import sqlite3
+import glob
+import time
+import uuid
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import requests
-from bs4 import BeautifulSoup
-import tempfile
+import requests_cache
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
+from mutagen import MutagenError
+from mutagen.mp4 import MP4
 
 # --- Konfiguration ---
 # Pfad im Container, aus docker-compose.yml gemountet
@@ -15,48 +23,244 @@ TARGET_DIR_CONTAINER = os.getenv("TARGET_DIR_CONTAINER", "/mnt/podcasts")
 # URLs (wie im PowerShell-Skript)
 MAIN_PAGE_URL = "https://www.deutschlandfunk.de/klassik-pop-et-cetera-100.html"
 BASE_URL = "https://www.deutschlandfunk.de" # Wird verwendet, falls relative URLs extrahiert werden
+# Podcast-Feed der Sendung: liefert alle Metadaten mit einem einzigen Abruf.
+# Leer setzen, um direkt die Webseite zu verwenden.
+FEED_URL = os.getenv("FEED_URL", "https://www.deutschlandfunk.de/klassik-pop-et-cetera-102.xml")
+ITUNES_NS = "{http://www.itunes.com/dtds/podcast-1.0.dtd}"
+
+# HTTP-Einstellungen: getrennte Timeouts für Verbindungsaufbau und Lesen (Sekunden)
+HTTP_TIMEOUT = (5, 20)
+HTTP_USER_AGENT = "Mozilla/5.0 (compatible; get-klassik-pop-etcetera)"
+# HTTP-Cache (SQLite) für Feed und Seiten; bei erneutem Lauf wird per ETag/If-Modified-Since revalidiert.
+# Für Wirkung über einen Container-Lauf hinaus muss der Pfad auf einem Volume liegen (siehe docker-compose.yml).
+HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH", "/tmp/dlf_cache")
+HTTP_CACHE_EXPIRE_SECONDS = 3600
 
 # Globale Pfade für Executables (im Container sind sie im PATH)
 YT_DLP_EXECUTABLE = "yt-dlp"
-FFMPEG_EXECUTABLE = "ffmpeg"
 
-# Temporäres Verzeichnis für Verarbeitungsdateien
-# Wir verwenden tempfile.TemporaryDirectory für automatische Bereinigung
-# Alternativ: Ein fester Pfad wie TEMP_PROCESSING_DIR = "/tmp/podcast_processing"
-
-def run_external_command(executable, arguments, workdir=None):
-    """Führt einen externen Befehl aus und gibt True bei Erfolg zurück, sonst False."""
+# CSS-Selektoren für Hauptseite und Episodenseite (selectolax/Lexbor)
+TEASER_SELECTOR = 'article.b-article-teaser'
+KICKER_SELECTOR = 'span.headline-kicker'
+HEADLINE_TITLE_SELECTOR = 'span.headline-title'
+DESCRIPTION_SELECTOR = 'p.article-header-description'
+TIME_SELECTOR = 'time'
+
+# Vorkompilierte Regex-Muster
+WS_RE = re.compile(r'\s{2,}')
+DATE_RE = re.compile(r'(\d{2}\.\d{2}\.\d{4})')
+HEADER_CHARSET_RE = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.IGNORECASE)
+
+# Übersetzungstabelle: ungültige Dateinamenzeichen und Zeilenumbrüche -> "_"
+_SANITIZE_TABLE = str.maketrans({c: "_" for c in '\\/*?:"<>|\n\r'})
+
+# Temporäre Downloaddatei
+# Liegt versteckt direkt im Zielordner, damit das abschließende Umbenennen auf demselben
+# Dateisystem passiert (kein Kopieren zwischen z.B. tmpfs und Bind-Mount).
+# Eindeutig pro Lauf per uuid4 – die PID ist im Container immer 1 und taugt daher nicht.
+TEMP_DOWNLOAD_PREFIX = ".podcast_dl_"
+TEMP_DOWNLOAD_STEM = f"{TEMP_DOWNLOAD_PREFIX}{uuid.uuid4().hex}"
+TEMP_DOWNLOAD_FILENAME = f"{TEMP_DOWNLOAD_STEM}.m4a"
+# Reste hart abgebrochener Läufe (SIGKILL, OOM) werden nach dieser Zeit entfernt
+STALE_TEMP_MAX_AGE_SECONDS = 24 * 3600
+
+def start_external_command(executable, arguments, workdir=None):
+    """Startet einen externen Befehl, ohne auf sein Ende zu warten.
+
+    STDOUT und STDERR werden nicht gepuffert, sondern direkt an die Ausgabe des Skripts
+    (bzw. des Containers) weitergereicht.
+    Gibt (Prozess, None) zurück, bei einem Fehler (None, Fehlermeldung).
+    """
     command = [executable] + arguments
     command_str = " ".join(command) # Für die Ausgabe
     print(f"Führe aus: {command_str}", flush=True)
     try:
-        process = subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8', cwd=workdir)
-        print(f"{executable} STDOUT:\n{process.stdout}", flush=True)
-        if process.stderr:
-            print(f"{executable} STDERR:\n{process.stderr}", flush=True)
-        print(f"{executable} erfolgreich abgeschlossen.", flush=True)
-        return True, process.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        print(f"Fehler: {executable} wurde mit Fehlercode {e.returncode} beendet.", flush=True)
-        print(f"{executable} STDOUT:\n{e.stdout}", flush=True)
-        print(f"{executable} STDERR:\n{e.stderr}", flush=True)
-        return False, e.stderr.strip()
+        # close_fds=False: Python-eigene Deskriptoren sind ohnehin nicht vererbbar (PEP 446),
+        # so entfällt das Schließen aller Deskriptoren vor dem exec.
+        process = subprocess.Popen(command, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir, close_fds=False)
+        return process, None
     except FileNotFoundError:
         print(f"Fehler: {executable} nicht gefunden. Ist es im Docker-Image korrekt installiert und im PATH?", flush=True)
-        return False, f"{executable} not found."
+        return None, f"{executable} not found."
+    except Exception as e:
+        print(f"Unerwarteter Fehler beim Ausführen von {executable}: {e}", flush=True)
+        return None, str(e)
+
+def wait_for_external_command(executable, process):
+    """Wartet auf einen mit start_external_command gestarteten Befehl.
+
+    Gibt (True, "") bei Erfolg zurück, sonst (False, Fehlermeldung).
+    """
+    try:
+        returncode = process.wait()
     except Exception as e:
         print(f"Unerwarteter Fehler beim Ausführen von {executable}: {e}", flush=True)
         return False, str(e)
+    if returncode != 0:
+        print(f"Fehler: {executable} wurde mit Fehlercode {returncode} beendet.", flush=True)
+        return False, f"{executable} exited with code {returncode}."
+    print(f"{executable} erfolgreich abgeschlossen.", flush=True)
+    return True, ""
+
+def stop_external_command(executable, process):
+    """Bricht einen noch laufenden, im Hintergrund gestarteten Befehl ab."""
+    if process.poll() is not None:
+        return
+    print(f"Breche {executable} ab...", flush=True)
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def create_http_session():
+    """Erstellt eine gecachte Session, die Verbindungen (Keep-Alive) zwischen den Abrufen wiederverwendet.
+
+    Lässt sich der Cache unter HTTP_CACHE_PATH nicht öffnen, wird eine normale Session ohne Cache verwendet.
+    """
+    try:
+        # cache_control=True: Cache-Control-Header des Servers haben Vorrang vor expire_after
+        session = requests_cache.CachedSession(HTTP_CACHE_PATH, expire_after=HTTP_CACHE_EXPIRE_SECONDS, cache_control=True)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warnung: HTTP-Cache {HTTP_CACHE_PATH} kann nicht geöffnet werden ({e}). Fahre ohne Cache fort.", flush=True)
+        session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'User-Agent': HTTP_USER_AGENT,
+        # brotli wird von urllib3 nur dekodiert, wenn das Paket brotli installiert ist
+        'Accept-Encoding': 'br, gzip, deflate',
+    })
+    return session
+
+def fetch_latest_episode_from_feed(session):
+    """Liest die neueste Episode aus dem Podcast-Feed.
+
+    Gibt ein dict mit Episoden-URL, Download-URL und Metadaten zurück,
+    oder None, falls der Feed nicht verfügbar oder nicht verwertbar ist.
+    """
+    try:
+        feed_response = session.get(FEED_URL, timeout=HTTP_TIMEOUT)
+        feed_response.raise_for_status()
+        feed_root = etree.fromstring(feed_response.content)
+    except (requests.exceptions.RequestException, etree.XMLSyntaxError) as e:
+        print(f"   Feed {FEED_URL} nicht verfügbar: {e}", flush=True)
+        return None
+
+    item = feed_root.find('channel/item')
+    if item is None:
+        print("   Feed enthält keine Episode.", flush=True)
+        return None
+
+    enclosure = item.find('enclosure')
+    enclosure_url = enclosure.get('url') if enclosure is not None else None
+    episode_url = (item.findtext('link') or "").strip() or enclosure_url
+    if not episode_url:
+        print("   Feed-Eintrag enthält weder Link noch Audiodatei.", flush=True)
+        return None
+
+    # yt-dlp lädt mit -f m4a; die Audiodatei nur direkt verwenden, wenn sie bereits M4A ist,
+    # sonst die Episodenseite an yt-dlp übergeben (wie im HTML-Pfad).
+    download_url = episode_url
+    if enclosure_url and (enclosure.get('type') in ('audio/mp4', 'audio/x-m4a') or enclosure_url.endswith('.m4a')):
+        download_url = enclosure_url
+
+    # Beschreibung kann HTML enthalten
+    description = (item.findtext('description') or "").strip()
+    if description and '<' in description:
+        # Leerzeichen zwischen den Elementen (z.B. <p>, <br>), WS_RE fasst doppelte unten zusammen
+        description = LexborHTMLParser(description).body.text(separator=' ').strip()
+
+    pub_date = (item.findtext('pubDate') or "").strip()
+    try:
+        iso_date = parsedate_to_datetime(pub_date).strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        print(f"Konnte Datum '{pub_date}' aus dem Feed nicht parsen. Verwende aktuelles Datum.", flush=True)
+        iso_date = datetime.now().strftime('%Y-%m-%d')
+
+    return {
+        'episode_url': episode_url,
+        'download_url': download_url,
+        'title': (item.findtext('title') or "").strip() or "Unbekannter Sendungstitel",
+        'subtitle': (item.findtext(f'{ITUNES_NS}subtitle') or "").strip(),
+        'description': WS_RE.sub(' ', description),
+        'date': iso_date,
+    }
+
+def html_for_parser(response):
+    """Gibt den Inhalt einer HTML-Antwort für LexborHTMLParser zurück.
+
+    Lexbor dekodiert Bytes immer als UTF-8. Bei UTF-8 (oder ohne Angabe) werden die Bytes
+    direkt übergeben, bei einem anderen deklarierten Zeichensatz (Content-Type-Header oder
+    <meta charset>) wird vorher selbst dekodiert.
+    """
+    content = response.content
+    charset_match = HEADER_CHARSET_RE.search(response.headers.get('Content-Type', ''))
+    if charset_match:
+        charset = charset_match.group(1)
+    else:
+        meta_match = META_CHARSET_RE.search(content[:4096])
+        charset = meta_match.group(1).decode('ascii', 'replace') if meta_match else None
+    if not charset:
+        return content
+    try:
+        if codecs.lookup(charset).name == 'utf-8':
+            return content
+        return content.decode(charset, errors='replace')
+    except LookupError:
+        print(f"Warnung: Unbekannter Zeichensatz '{charset}' für {response.url}, dekodiere als UTF-8.", flush=True)
+        return content
+
+def first_element_text(node, selector):
+    """Gibt den bereinigten Text des ersten Treffers eines CSS-Selektors zurück, sonst None."""
+    element = node.css_first(selector)
+    # Text aller Kindknoten ohne Trenner zusammensetzen und erst danach trimmen (wie .text.strip())
+    return element.text(deep=True, separator='', strip=False).strip() if element else None
+
+def parse_teaser_date(text):
+    """Sucht ein Datum im Format dd.MM.yyyy und gibt es als ISO-Datum zurück, sonst None."""
+    date_match_obj = DATE_RE.search(text or "")
+    if not date_match_obj:
+        return None
+    try:
+        return datetime.strptime(date_match_obj.group(1), '%d.%m.%Y').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+def find_existing_episode_file(iso_date):
+    """Sucht im Zielordner eine bereits heruntergeladene Episode vom angegebenen Datum."""
+    # Dateinamen beginnen mit dem ISO-Datum, siehe final_filename in main()
+    pattern = os.path.join(glob.escape(TARGET_DIR_CONTAINER), f"{iso_date} *.m4a")
+    matches = glob.glob(pattern)
+    return matches[0] if matches else None
+
+def remove_stale_temp_files():
+    """Entfernt temporäre Downloaddateien früherer, hart abgebrochener Läufe aus dem Zielordner."""
+    # Nur alte Dateien, damit ein parallel laufender Download nicht gestört wird
+    pattern = os.path.join(glob.escape(TARGET_DIR_CONTAINER), f"{TEMP_DOWNLOAD_PREFIX}*")
+    for stale_path in glob.glob(pattern):
+        try:
+            if time.time() - os.path.getmtime(stale_path) > STALE_TEMP_MAX_AGE_SECONDS:
+                os.remove(stale_path)
+                print(f"   Veraltete temporäre Datei entfernt: {stale_path}", flush=True)
+        except OSError as e:
+            print(f"   Konnte veraltete temporäre Datei {stale_path} nicht entfernen: {e}", flush=True)
 
 def sanitize_filename_component(name_component):
     """Bereinigt einen String, um ihn als Teil eines Dateinamens sicher zu verwenden."""
     # Entferne ungültige Zeichen (Windows-Perspektive als strengste Annahme, aber anpassbar)
     # In Linux sind weniger Zeichen ungültig, aber / darf nicht vorkommen.
     # Für Cross-Plattform-Sicherheit oder Docker-interne Namen ist es gut, restriktiv zu sein.
-    name_component = re.sub(r'[\\/*?:"<>|]', "_", name_component)
-    name_component = name_component.replace("\n", "_").replace("\r", "_")
-    return name_component.strip()
+    return name_component.translate(_SANITIZE_TABLE).strip()
 
+def normalize_metadata_value(text):
+    """Vereinheitlicht Zeilenumbrüche eines Metadaten-Werts für die MP4-Tags."""
+    # Anführungszeichen und Sonderzeichen im PowerShell-Skript mit -replace "&quot;", '"' behandelt.
+    # Die HTML-Parser liefern bereits unescapten Text.
+    # Die Werte werden von mutagen direkt in die MP4-Atome geschrieben, Escaping ist nicht nötig.
+    return "" if text is None else "\n".join(text.splitlines())
 
 def main():
     """Hauptlogik des Skripts."""
@@ -70,104 +274,148 @@ def main():
         print(f"Fehler beim Erstellen des Zielordners {TARGET_DIR_CONTAINER}: {e}", flush=True)
         sys.exit(1)
 
-    # Temporäres Verzeichnis für alle Operationen erstellen
-    with tempfile.TemporaryDirectory(prefix="podcast_dl_") as temp_dir:
-        print(f"Temporäres Verzeichnis erstellt: {temp_dir}", flush=True)
+    # Gemeinsame HTTP-Session, damit die Episodenseite die Verbindung zur Hauptseite wiederverwendet
+    session = create_http_session()
 
-        # 1. Lade Hauptseite
-        print(f"1. Lade Hauptseite: {MAIN_PAGE_URL}", flush=True)
-        try:
-            main_page_response = requests.get(MAIN_PAGE_URL, timeout=20)
-            main_page_response.raise_for_status()
-            main_page_html = main_page_response.text
-        except requests.exceptions.RequestException as e:
-            print(f"Fehler beim Laden der Hauptseite {MAIN_PAGE_URL}: {e}", flush=True)
-            sys.exit(1)
+    remove_stale_temp_files()
 
-        # 2. Finde Link zur neuesten Episode
-        print("2. Suche Link zur neuesten Episode...", flush=True)
-        # Regex aus PowerShell: (?s)<article class="b-article-teaser.*?<a href="(?<relativeUrl>[^"]+)"
-        # Python's re.search findet den ersten Treffer. re.DOTALL entspricht (?s)
-        match = re.search(r'<article class="b-article-teaser.*?<a href="(?P<relativeUrl>[^"]+)"', main_page_html, re.DOTALL)
-
-        if not match:
-            print("Konnte den Link zur neuesten Episode auf der Hauptseite nicht finden. Seitenstruktur geändert?", flush=True)
-            # Versuch mit BeautifulSoup als Fallback oder primäre Methode
-            soup_main = BeautifulSoup(main_page_html, 'html.parser')
-            article_teaser = soup_main.find('article', class_='b-article-teaser')
-            episode_link_tag = None
-            if article_teaser:
-                # Suchen nach einem Link innerhalb des Teasers. Annahme: der erste passende Link
-                # Die genaue Klasse oder Struktur muss evtl. angepasst werden.
-                # PS-Skript erwähnt 'teaser-title', aber die Regex ist allgemeiner.
-                episode_link_tag = article_teaser.find('a', href=True) # Nimmt den ersten Link mit href
-
-            if not episode_link_tag or not episode_link_tag.get('href'):
-                 print("Auch mit BeautifulSoup keinen passenden Episodenlink gefunden.", flush=True)
-                 sys.exit(1)
-            relative_episode_url = episode_link_tag['href']
-        else:
-            relative_episode_url = match.group('relativeUrl')
+    # Pfad für die temporäre Downloaddatei (wird direkt getaggt und dann umbenannt)
+    temp_download_path_m4a = os.path.join(TARGET_DIR_CONTAINER, TEMP_DOWNLOAD_FILENAME)
 
-        # URL zusammensetzen (falls relativ)
-        if relative_episode_url.startswith('/'):
-            episode_url = BASE_URL + relative_episode_url
-        else: # Falls es schon eine volle URL ist
-            episode_url = relative_episode_url
-        print(f"   Link zur neuesten Episode gefunden: {episode_url}", flush=True)
-
-        # 3. Lade Episodenseite für Metadaten
-        print(f"3. Lade Episodenseite für Metadaten: {episode_url}", flush=True)
-        try:
-            episode_page_response = requests.get(episode_url, timeout=20)
-            episode_page_response.raise_for_status()
-            episode_html_content = episode_page_response.text
-            soup_episode = BeautifulSoup(episode_html_content, 'html.parser')
-        except requests.exceptions.RequestException as e:
-            print(f"Fehler beim Laden der Episodenseite {episode_url}: {e}", flush=True)
+    try:
+        # 1. Versuche zuerst den Podcast-Feed (ein Abruf für Link und Metadaten)
+        feed_episode = None
+        if FEED_URL:
+            print(f"1. Lade Podcast-Feed: {FEED_URL}", flush=True)
+            feed_episode = fetch_latest_episode_from_feed(session)
+
+        if feed_episode:
+            episode_url = feed_episode['episode_url']
+            download_url = feed_episode['download_url']
+            episode_iso_date = feed_episode['date']
+            print(f"   Neueste Episode im Feed gefunden: {episode_url}", flush=True)
+        else:
+            # Fallback: Hauptseite und Episodenseite auswerten
+            # 2. Lade Hauptseite
+            print(f"2. Lade Hauptseite: {MAIN_PAGE_URL}", flush=True)
+            try:
+                main_page_response = session.get(MAIN_PAGE_URL, timeout=HTTP_TIMEOUT)
+                main_page_response.raise_for_status()
+                main_page_html = html_for_parser(main_page_response)
+            except requests.exceptions.RequestException as e:
+                print(f"Fehler beim Laden der Hauptseite {MAIN_PAGE_URL}: {e}", flush=True)
+                sys.exit(1)
+
+            # Finde Link zur neuesten Episode
+            print("   Suche Link zur neuesten Episode...", flush=True)
+            # Entspricht der Regex aus dem PowerShell-Skript:
+            # (?s)<article class="b-article-teaser.*?<a href="(?<relativeUrl>[^"]+)"
+            # Gesucht ist der erste Link mit href im ersten passenden Teaser.
+            main_tree = LexborHTMLParser(main_page_html)
+            teaser = None
+            relative_episode_url = None
+            for teaser in main_tree.css(TEASER_SELECTOR):
+                episode_link_node = teaser.css_first('a[href]')
+                if episode_link_node:
+                    relative_episode_url = episode_link_node.attributes.get('href')
+                    break
+            if not relative_episode_url:
+                print("Konnte den Link zur neuesten Episode auf der Hauptseite nicht finden. Seitenstruktur geändert?", flush=True)
+                sys.exit(1)
+
+            # URL zusammensetzen (falls relativ)
+            if relative_episode_url.startswith('/'):
+                episode_url = BASE_URL + relative_episode_url
+            else: # Falls es schon eine volle URL ist
+                episode_url = relative_episode_url
+            print(f"   Link zur neuesten Episode gefunden: {episode_url}", flush=True)
+            download_url = episode_url
+
+            # Datum aus dem Teaser (falls vorhanden) für die Vorabprüfung
+            episode_iso_date = parse_teaser_date(first_element_text(teaser, TIME_SELECTOR))
+
+        # Vorabprüfung: Gibt es bereits eine Episode von diesem Datum, sind Episodenseite und Download unnötig
+        if episode_iso_date:
+            existing_filepath = find_existing_episode_file(episode_iso_date)
+            if existing_filepath:
+                print(f"   Episode vom {episode_iso_date} existiert bereits: {existing_filepath}. Download wird übersprungen.", flush=True)
+                sys.exit(0)
+
+        # 3. Starte Download der Episode mit yt-dlp im Hintergrund
+        # Der Download (netzwerkgebunden) läuft parallel zum Laden der Episodenseite,
+        # dem Extrahieren der Metadaten und der Prüfung auf eine vorhandene Zieldatei (Schritte 4-6).
+        print(f"3. Starte Download der Episode im Hintergrund nach: {temp_download_path_m4a}", flush=True)
+        yt_dlp_args = [
+            "-f", "m4a",                     # Format M4A
+            "--no-continue",                 # Keine alten .part-Dateien fortsetzen
+            "--force-overwrites",            # Vorhandene Datei nie als "bereits heruntergeladen" werten
+            "--output", temp_download_path_m4a, # Ausgabe-Dateipfad
+            download_url                     # URL der Episode bzw. Audiodatei aus dem Feed
+        ]
+        download_process, _ = start_external_command(YT_DLP_EXECUTABLE, yt_dlp_args)
+        if download_process is None:
+            print("yt-dlp Download konnte nicht gestartet werden.", flush=True)
             sys.exit(1)
 
-        # 4. Extrahiere Metadaten
-        print("4. Extrahiere Metadaten...", flush=True)
-        try:
-            # Künstlername / Episodentitel (aus <span class="headline-kicker">)
-            kicker_element = soup_episode.find('span', class_='headline-kicker')
-            meta_episode_title = kicker_element.text.strip() if kicker_element else "Unbekannter Sendungstitel"
-
-            # Untertitel (aus <span class="headline-title">) -> wird für 'description' Tag verwendet
-            headline_title_element = soup_episode.find('span', class_='headline-title')
-            meta_subtitle_for_description_tag = headline_title_element.text.strip() if headline_title_element else ""
-
-            # Beschreibung (aus <p class="article-header-description">) -> wird für 'comment' Tag verwendet
-            desc_element = soup_episode.find('p', class_='article-header-description')
-            meta_description_for_comment_tag = desc_element.text.strip() if desc_element else ""
-            meta_description_for_comment_tag = re.sub(r'\s{2,}', ' ', meta_description_for_comment_tag) # Mehrere Leerzeichen ersetzen
-
-            # Datum (aus <time>)
-            time_element = soup_episode.find('time')
-            date_str_raw = time_element.text.strip() if time_element else ""
-            date_match_obj = re.search(r'(\d{2}\.\d{2}\.\d{4})', date_str_raw)
-            meta_iso_date_str = ""
-            if date_match_obj:
-                try:
-                    parsed_date = datetime.strptime(date_match_obj.group(1), '%d.%m.%Y')
-                    meta_iso_date_str = parsed_date.strftime('%Y-%m-%d')
-                except ValueError:
-                    print(f"Konnte Datum '{date_match_obj.group(1)}' nicht parsen. Verwende aktuelles Datum.", flush=True)
+        if feed_episode:
+            print("   Metadaten aus dem Feed übernommen.", flush=True)
+            meta_episode_title = feed_episode['title']
+            meta_subtitle_for_description_tag = feed_episode['subtitle']
+            meta_description_for_comment_tag = feed_episode['description']
+            meta_iso_date_str = feed_episode['date']
+        else:
+            # 4. Lade Episodenseite für Metadaten
+            # Die URL stammt aus der Hauptseite, die Abrufe sind also nicht parallelisierbar.
+            # Die Wartezeit wird stattdessen vom bereits laufenden Download überdeckt.
+            print(f"4. Lade Episodenseite für Metadaten: {episode_url}", flush=True)
+            try:
+                episode_page_response = session.get(episode_url, timeout=HTTP_TIMEOUT)
+                episode_page_response.raise_for_status()
+                episode_html_content = html_for_parser(episode_page_response)
+                episode_tree = LexborHTMLParser(episode_html_content)
+            except requests.exceptions.RequestException as e:
+                print(f"Fehler beim Laden der Episodenseite {episode_url}: {e}", flush=True)
+                stop_external_command(YT_DLP_EXECUTABLE, download_process)
+                sys.exit(1)
+
+            # 5. Extrahiere Metadaten
+            print("5. Extrahiere Metadaten...", flush=True)
+            try:
+                # Künstlername / Episodentitel (aus <span class="headline-kicker">)
+                meta_episode_title = first_element_text(episode_tree, KICKER_SELECTOR) or "Unbekannter Sendungstitel"
+
+                # Untertitel (aus <span class="headline-title">) -> wird für 'description' Tag verwendet
+                meta_subtitle_for_description_tag = first_element_text(episode_tree, HEADLINE_TITLE_SELECTOR) or ""
+
+                # Beschreibung (aus <p class="article-header-description">) -> wird für 'comment' Tag verwendet
+                meta_description_for_comment_tag = first_element_text(episode_tree, DESCRIPTION_SELECTOR) or ""
+                meta_description_for_comment_tag = WS_RE.sub(' ', meta_description_for_comment_tag) # Mehrere Leerzeichen ersetzen
+
+                # Datum (aus <time>)
+                date_str_raw = first_element_text(episode_tree, TIME_SELECTOR) or ""
+                date_match_obj = DATE_RE.search(date_str_raw)
+                meta_iso_date_str = ""
+                if date_match_obj:
+                    try:
+                        parsed_date = datetime.strptime(date_match_obj.group(1), '%d.%m.%Y')
+                        meta_iso_date_str = parsed_date.strftime('%Y-%m-%d')
+                    except ValueError:
+                        print(f"Konnte Datum '{date_match_obj.group(1)}' nicht parsen. Verwende aktuelles Datum.", flush=True)
+                        meta_iso_date_str = datetime.now().strftime('%Y-%m-%d')
+                else:
+                    print(f"Kein Datum im Format dd.MM.yyyy in '{date_str_raw}' gefunden. Verwende aktuelles Datum.", flush=True)
                     meta_iso_date_str = datetime.now().strftime('%Y-%m-%d')
-            else:
-                print(f"Kein Datum im Format dd.MM.yyyy in '{date_str_raw}' gefunden. Verwende aktuelles Datum.", flush=True)
-                meta_iso_date_str = datetime.now().strftime('%Y-%m-%d')
 
-            print("   Metadaten extrahiert:", flush=True)
-            print(f"     Sendungstitel (für Dateiname & title-Tag): {meta_episode_title}", flush=True)
-            print(f"     Untertitel (für description-Tag):         {meta_subtitle_for_description_tag}", flush=True)
-            print(f"     Beschreibung (für comment-Tag):          {meta_description_for_comment_tag[:80]}...", flush=True)
-            print(f"     Datum (ISO):                            {meta_iso_date_str}", flush=True)
+            except Exception as e:
+                print(f"Fehler beim Extrahieren der Metadaten: {e}", flush=True)
+                stop_external_command(YT_DLP_EXECUTABLE, download_process)
+                sys.exit(1)
 
-        except Exception as e:
-            print(f"Fehler beim Extrahieren der Metadaten: {e}", flush=True)
-            sys.exit(1)
+        print("   Metadaten extrahiert:", flush=True)
+        print(f"     Sendungstitel (für Dateiname & title-Tag): {meta_episode_title}", flush=True)
+        print(f"     Untertitel (für description-Tag):         {meta_subtitle_for_description_tag}", flush=True)
+        print(f"     Beschreibung (für comment-Tag):          {meta_description_for_comment_tag[:80]}...", flush=True)
+        print(f"     Datum (ISO):                            {meta_iso_date_str}", flush=True)
 
         # Bereinige Sendungstitel für Dateinamen
         safe_filename_episode_title = sanitize_filename_component(meta_episode_title)
@@ -178,92 +426,69 @@ def main():
         print(f"   Finaler Dateiname: {final_filename}", flush=True)
         print(f"   Zielpfad (im Container): {final_filepath_in_target_dir}", flush=True)
 
-        # 5. Prüfe, ob Zieldatei bereits existiert
-        print(f"5. Prüfe, ob Zieldatei bereits existiert: {final_filepath_in_target_dir}", flush=True)
+        # 6. Prüfe, ob Zieldatei bereits existiert
+        print(f"6. Prüfe, ob Zieldatei bereits existiert: {final_filepath_in_target_dir}", flush=True)
         if os.path.exists(final_filepath_in_target_dir):
-            print("   Datei existiert bereits. Download wird übersprungen.", flush=True)
+            print("   Datei existiert bereits. Download wird abgebrochen.", flush=True)
+            stop_external_command(YT_DLP_EXECUTABLE, download_process)
             sys.exit(0)
         else:
             print("   Datei existiert noch nicht.", flush=True)
 
-        # Pfade für temporäre Dateien (Download, Metadaten, getaggte Ausgabe)
-        temp_download_path_m4a = os.path.join(temp_dir, "downloaded_audio_temp.m4a")
-        temp_metadata_filepath = os.path.join(temp_dir, "metadata.txt")
-        temp_tagged_output_path_m4a = os.path.join(temp_dir, "tagged_audio_temp.m4a")
-
-        # 6. Lade Episode mit yt-dlp herunter
-        print(f"6. Lade Episode herunter nach: {temp_download_path_m4a}", flush=True)
-        yt_dlp_args = [
-            "-f", "m4a",                     # Format M4A
-            "--output", temp_download_path_m4a, # Ausgabe-Dateipfad
-            episode_url                      # URL der Episode
-        ]
-        success, _ = run_external_command(YT_DLP_EXECUTABLE, yt_dlp_args)
+        # 7. Warte auf den Abschluss des Downloads
+        print("7. Warte auf Abschluss des Downloads...", flush=True)
+        success, _ = wait_for_external_command(YT_DLP_EXECUTABLE, download_process)
         if not success or not os.path.exists(temp_download_path_m4a):
             print("yt-dlp Download fehlgeschlagen oder Datei nicht erstellt.", flush=True)
-            # Bereinigung des temp_dir erfolgt automatisch durch with-Statement
+            # Bereinigung der temporären Datei erfolgt im finally-Block
             sys.exit(1)
 
-        # 7. Schreibe Metadaten für ffmpeg
-        print(f"7. Erstelle FFMETADATA-Datei: {temp_metadata_filepath}", flush=True)
-        # Anführungszeichen und Sonderzeichen im PowerShell-Skript mit -replace "&quot;", '"' behandelt.
-        # Python's HTML-Parser (BeautifulSoup) sollte dies bereits erledigen (gibt unescaped Text zurück).
-        # Wir müssen aber Zeilenumbrüche und Backslashes für FFMETADATA escapen.
-        def escape_for_ffmetadata(text):
-            if text is None: return ""
-            return text.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('=', '\\=')
-
-        ffmetadata_content = [
-            ";FFMETADATA1",
-            f"album=Klassik, Pop et cetera",
-            f"artist=Deutschlandfunk", # Wie im PS-Skript hartkodiert
-            f"title={escape_for_ffmetadata(meta_episode_title)}",
-            f"description={escape_for_ffmetadata(meta_subtitle_for_description_tag)}", # PS: Untertitel -> description
-            f"comment={escape_for_ffmetadata(meta_description_for_comment_tag)}",    # PS: Beschreibung -> comment
-            f"date={escape_for_ffmetadata(meta_iso_date_str)}",
-            f"copyright={escape_for_ffmetadata(episode_url)}", # URL als Copyright
-            f"show=Klassik, Pop et cetera"
+        # 8. Tagge mit mutagen
+        # mutagen schreibt nur die Metadaten-Atome neu, die Audiodaten werden nicht kopiert.
+        print(f"8. Tagge Audiodatei mit mutagen: {temp_download_path_m4a}", flush=True)
+        # MP4-Atome der bisher über ffmpeg gesetzten Tags (wie im PS-Skript)
+        metadata_tags = [
+            ("\xa9alb", "Klassik, Pop et cetera"),              # album
+            ("\xa9ART", "Deutschlandfunk"),                     # artist, wie im PS-Skript hartkodiert
+            ("\xa9nam", meta_episode_title),                    # title
+            ("desc", meta_subtitle_for_description_tag),        # description, PS: Untertitel -> description
+            ("\xa9cmt", meta_description_for_comment_tag),      # comment, PS: Beschreibung -> comment
+            ("\xa9day", meta_iso_date_str),                     # date
+            ("cprt", episode_url),                              # copyright, URL als Copyright
+            ("tvsh", "Klassik, Pop et cetera"),                 # show
         ]
         try:
-            with open(temp_metadata_filepath, 'w', encoding='utf-8') as f:
-                f.write("\n".join(ffmetadata_content))
-            print("   FFMETADATA-Datei erfolgreich geschrieben.", flush=True)
-        except IOError as e:
-            print(f"Fehler beim Schreiben der Metadaten-Datei {temp_metadata_filepath}: {e}", flush=True)
-            sys.exit(1)
-
-        # 8. Tagge mit ffmpeg
-        print(f"8. Tagge Audiodatei mit ffmpeg (Ausgabe nach: {temp_tagged_output_path_m4a})", flush=True)
-        ffmpeg_args = [
-            "-i", temp_download_path_m4a,        # Eingabe-Audiodatei (geändert von PS, erst Audio, dann Metadaten-Datei)
-            "-i", temp_metadata_filepath,       # Eingabe-Metadatendatei
-            "-map_metadata", "1",               # Metadaten vom zweiten Input (metadata.txt)
-            "-map", "0:a",                      # Audiostreams vom ersten Input (audio.m4a)
-            "-codec", "copy",                   # Keine Neukodierung
-            "-y",                               # Überschreibe Ausgabedatei, falls vorhanden
-            temp_tagged_output_path_m4a         # Ausgabedatei
-        ]
-        # Hinweis: Die Reihenfolge von -i und die -map Parameter sind wichtig.
-        # PS-Script: -i metadata -i audio -map_metadata 0 -map 1
-        # Hier angepasst: -i audio -i metadata -map_metadata 1 -map 0:a (map bezieht sich auf Input-Index)
-
-        success, _ = run_external_command(FFMPEG_EXECUTABLE, ffmpeg_args)
-        if not success or not os.path.exists(temp_tagged_output_path_m4a):
-            print("ffmpeg Metadaten-Tagging fehlgeschlagen oder Datei nicht erstellt.", flush=True)
+            audio = MP4(temp_download_path_m4a)
+            if audio.tags is None:
+                audio.add_tags()
+            audio.tags.clear() # Vorhandene Metadaten des Downloads verwerfen
+            for key, value in metadata_tags:
+                audio.tags[key] = [normalize_metadata_value(value)]
+            audio.save()
+            print("   Metadaten erfolgreich geschrieben.", flush=True)
+        except MutagenError as e:
+            print(f"Fehler beim Taggen der Datei {temp_download_path_m4a}: {e}", flush=True)
             sys.exit(1)
 
-        # 9. Verschiebe die fertige, getaggte Datei ins Zielverzeichnis
-        print(f"9. Verschiebe getaggte Datei nach: {final_filepath_in_target_dir}", flush=True)
+        # 9. Benenne die fertige, getaggte Datei im Zielverzeichnis um
+        print(f"9. Benenne getaggte Datei um nach: {final_filepath_in_target_dir}", flush=True)
         try:
-            shutil.move(temp_tagged_output_path_m4a, final_filepath_in_target_dir)
+            # Die temporäre Datei liegt im Zielordner: atomares Umbenennen ohne Kopieren der Daten
+            os.replace(temp_download_path_m4a, final_filepath_in_target_dir)
             print(f"   Datei erfolgreich nach {final_filepath_in_target_dir} verschoben.", flush=True)
         except Exception as e:
-            print(f"Fehler beim Verschieben der Datei {temp_tagged_output_path_m4a} nach {final_filepath_in_target_dir}: {e}", flush=True)
-            print(f"Die getaggte Datei befindet sich möglicherweise noch in: {temp_tagged_output_path_m4a}", flush=True)
+            print(f"Fehler beim Verschieben der Datei {temp_download_path_m4a} nach {final_filepath_in_target_dir}: {e}", flush=True)
             sys.exit(1)
 
-        # Temporäre Original-Downloaddatei (ohne Tags) wird nicht mehr explizit gelöscht, da temp_dir alles bereinigt.
-        # Der metadata.txt wird auch durch temp_dir bereinigt.
+    finally:
+        # Reste eines abgebrochenen oder fehlgeschlagenen Downloads entfernen. Neben der Datei selbst
+        # legt yt-dlp u.a. .part, .ytdl, .part-FragN (HLS/DASH) und .temp.m4a (M4A-Fixup) an.
+        leftover_pattern = os.path.join(glob.escape(TARGET_DIR_CONTAINER), glob.escape(TEMP_DOWNLOAD_STEM) + "*")
+        for leftover_path in glob.glob(leftover_pattern):
+            try:
+                os.remove(leftover_path)
+            except OSError as e:
+                print(f"Konnte temporäre Datei {leftover_path} nicht entfernen: {e}", flush=True)
 
     print("Skript erfolgreich abgeschlossen.", flush=True)
     sys.exit(0)